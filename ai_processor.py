@@ -1,37 +1,115 @@
 import os
 import json
-import time
 import re
-import requests
 import sys
+import time
+import asyncio
+import functools
 import configparser
+from types import MappingProxyType
+
+import aiohttp
+import orjson
+
+from config_cache import get_config, get_schema, get_headers, get_headers_sidecar_path
 
 PROCESSED_DATA_OUTPUT_FILE = "financial_extracted_data.json"
 
-def call_gemini_api_with_retries(prompt_content, api_url, max_retries, initial_delay, response_schema):
+# Fallback used only when the response is not clean JSON: grabs the outermost array/object.
+_JSON_RE = re.compile(r'(\[.*\]|\{.*\})', re.DOTALL)
+
+def _strip_code_fence(text):
+    """Removes surrounding whitespace and a markdown ```json fence, if present."""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text[3:]
+        if text[:4].lower() == "json":
+            text = text[4:]
+        if text.endswith("```"):
+            text = text[:-3]
+    return text.strip()
+
+def _parse_retry_after(headers):
+    """Returns the Retry-After header in seconds, or None if missing or not a number."""
+    try:
+        return max(0.0, float(headers.get('Retry-After')))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class RateLimiter:
+    """
+    Token-bucket limiter for requests per minute and tokens per minute.
+    Both buckets refill continuously, so requests are spaced out before the API has to reject them.
+    """
+    def __init__(self, rpm, tpm):
+        self.max_requests = float(rpm)
+        self.max_tokens = float(tpm)
+        self.available_requests = self.max_requests
+        self.available_tokens = self.max_tokens
+        self.last_update = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.available_requests = min(self.max_requests, self.available_requests + elapsed * self.max_requests / 60.0)
+        self.available_tokens = min(self.max_tokens, self.available_tokens + elapsed * self.max_tokens / 60.0)
+
+    async def acquire(self, estimated_tokens):
+        """Waits until one request and estimated_tokens tokens are available, then consumes them."""
+        # A single request larger than the whole budget would otherwise wait forever.
+        estimated_tokens = min(float(estimated_tokens), self.max_tokens)
+        while True:
+            self._refill()
+            if self.available_requests >= 1 and self.available_tokens >= estimated_tokens:
+                self.available_requests -= 1
+                self.available_tokens -= estimated_tokens
+                return
+            wait_for_request = (1 - self.available_requests) * 60.0 / self.max_requests
+            wait_for_tokens = (estimated_tokens - self.available_tokens) * 60.0 / self.max_tokens
+            await asyncio.sleep(max(wait_for_request, wait_for_tokens, 0.01))
+
+async def call_gemini_api_async(session, prompt_content, api_url, response_schema, sem, limiter, max_retries, initial_delay, max_output_tokens):
     """
     Calls the Gemini API with a dynamic schema and exponential backoff.
+    The semaphore bounds how many requests are in flight at the same time and the
+    limiter keeps them within the configured requests/tokens per minute.
+    Timeouts, 429s and 5xx responses are retried; any other 4xx is raised immediately.
     """
     payload = {
         "contents": [{"role": "user", "parts": [{"text": prompt_content}]}],
         "generationConfig": {
             "responseMimeType": "application/json",
-            "responseSchema": response_schema  # Use the schema from config
+            "responseSchema": response_schema,  # Use the schema from config
+            "maxOutputTokens": max_output_tokens,
+            "temperature": 0.0
         }
     }
+    # Rough estimate (~4 characters per token) plus the worst-case response size.
+    estimated_tokens = len(prompt_content) // 4 + max_output_tokens
 
     for attempt in range(max_retries):
+        retry_after = None
         try:
-            response = requests.post(api_url, headers={'Content-Type': 'application/json'}, json=payload)
-            response.raise_for_status()
-            result = response.json()
+            async with sem:
+                await limiter.acquire(estimated_tokens)
+                async with session.post(api_url, json=payload) as response:
+                    response.raise_for_status()
+                    result = await response.json()
 
-            if result.get("candidates") and result["candidates"][0].get("content"):
-                json_string = result["candidates"][0]["content"]["parts"][0]["text"]
+            if result.get("candidates") and result["candidates"][0].get("finishReason") == "MAX_TOKENS":
+                # A truncated array cannot be parsed reliably (the regex fallback would return a fragment),
+                # and with temperature 0 a retry would be cut off at the same point.
+                print(f"Gemini response was cut off at max_output_tokens ({max_output_tokens}); "
+                      "no transactions were extracted from this file. Increase max_output_tokens "
+                      "or lower combination_count in config.ini.")
+                return None
+            elif result.get("candidates") and result["candidates"][0].get("content"):
+                json_string = _strip_code_fence(result["candidates"][0]["content"]["parts"][0]["text"])
                 try:
                     return json.loads(json_string)
                 except json.JSONDecodeError:
-                    match = re.search(r'\[.*\]|\{.*\}', json_string, re.DOTALL)
+                    match = _JSON_RE.search(json_string)
                     if match:
                         try:
                             return json.loads(match.group(0))
@@ -42,15 +120,25 @@ def call_gemini_api_with_retries(prompt_content, api_url, max_retries, initial_d
             else:
                  print(f"Attempt {attempt + 1}: Gemini API returned unexpected structure: {result}")
 
-        except requests.exceptions.RequestException as e:
+        except aiohttp.ClientResponseError as e:
+            if 400 <= e.status < 500 and e.status != 429:
+                # Client errors (bad key, malformed request, ...) will not succeed on retry.
+                raise RuntimeError(f"Gemini API rejected the request with status {e.status}: {e.message}") from e
+            print(f"Attempt {attempt + 1}: Gemini API returned status {e.status}: {e.message}")
+            if e.status == 429:
+                retry_after = _parse_retry_after(e.headers)
+        except asyncio.TimeoutError:
+            print(f"Attempt {attempt + 1}: Request timed out.")
+        except aiohttp.ClientError as e:
             print(f"Attempt {attempt + 1}: Request failed: {e}")
         except Exception as e:
             print(f"Attempt {attempt + 1}: An unexpected error occurred: {e}")
 
         if attempt < max_retries - 1:
-            delay = initial_delay * (2 ** attempt)
+            # Honour the server's Retry-After on 429s instead of guessing with backoff.
+            delay = retry_after if retry_after is not None else initial_delay * (2 ** attempt)
             print(f"Retrying in {delay:.2f} seconds...")
-            time.sleep(delay)
+            await asyncio.sleep(delay)
         else:
             print("Max retries reached. Failed to get a valid response from Gemini API.")
     return None
@@ -59,47 +147,52 @@ def load_metadata(target_folder_path):
     """Loads the files_metadata.json to map filenames to Google Drive links."""
     metadata_path = os.path.join(target_folder_path, 'files_metadata.json')
     if not os.path.exists(metadata_path):
-        return {}
+        return MappingProxyType({})
+    # The modification time is part of the cache key, so an updated metadata file is re-read.
+    return _load_metadata_cached(metadata_path, os.path.getmtime(metadata_path))
+
+@functools.lru_cache(maxsize=8)
+def _load_metadata_cached(metadata_path, mtime):
+    """Parses files_metadata.json; the result is read-only because it is shared between callers."""
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        return {
+        with open(metadata_path, 'rb') as f:
+            metadata = orjson.loads(f.read())
+        return MappingProxyType({
             file_info.get('filename'): file_info.get('link', 'Link not available')
             for file_info in metadata.values() if file_info.get('filename')
-        }
+        })
     except Exception as e:
         print(f"Error loading metadata: {e}")
-        return {}
+        return MappingProxyType({})
 
-def process_combined_text_file(file_path, filename_to_link_mapping, api_url, max_retries, initial_delay, prompt_template, response_schema):
+async def process_combined_text_file(session, sem, limiter, file_path, filename_to_link_mapping, api_url, max_retries, initial_delay, max_output_tokens, prompt_template, response_schema, defined_fields, fields_for_prompt):
     """
     Reads a text file, builds a prompt from the config template, and extracts data.
     """
     try:
+        print(f"\n--- Processing file: {os.path.basename(file_path)} ---")
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
 
-        # Dynamically create the list of fields from the schema for the prompt
-        fields_for_prompt = ", ".join(response_schema.get("items", {}).get("properties", {}).keys())
-        
         # Format the prompt with the fields and the file content
         prompt_for_gemini = prompt_template.format(fields=fields_for_prompt, content=content)
 
-        gemini_response = call_gemini_api_with_retries(prompt_for_gemini, api_url, max_retries, initial_delay, response_schema)
+        gemini_response = await call_gemini_api_async(
+            session, prompt_for_gemini, api_url, response_schema, sem, limiter, max_retries, initial_delay, max_output_tokens
+        )
 
         if not gemini_response:
             print(f"No data extracted by Gemini for {os.path.basename(file_path)}")
             return []
+        if isinstance(gemini_response, dict):
+            # A single transaction object instead of the requested array
+            gemini_response = [gemini_response]
 
         # Dynamically process the fields defined in the schema
         extracted_data = []
-        defined_fields = list(response_schema.get("items", {}).get("properties", {}).keys())
-        
         for transaction in gemini_response:
-            processed_transaction = {}
-            for field in defined_fields:
-                processed_transaction[field] = transaction.get(field, "N/A")
-            
+            processed_transaction = {field: transaction.get(field, "N/A") for field in defined_fields}
+
             # Add the drive link separately
             original_name = transaction.get('original_file_name')
             processed_transaction['drive_link'] = filename_to_link_mapping.get(original_name, 'Link not found')
@@ -111,10 +204,30 @@ def process_combined_text_file(file_path, filename_to_link_mapping, api_url, max
         print(f"Error processing combined file {file_path}: {e}")
         return []
 
+async def run_all(file_paths, filename_to_link_mapping, api_url, max_retries, initial_delay, max_output_tokens, prompt_template, response_schema, defined_fields, fields_for_prompt, max_concurrency, read_timeout, rpm, tpm):
+    """Processes all text files concurrently, keeping at most max_concurrency Gemini calls in flight."""
+    sem = asyncio.Semaphore(max_concurrency)
+    limiter = RateLimiter(rpm, tpm)
+    # One pooled session for the whole run so keep-alive connections (and the TLS
+    # handshake) to the Gemini host are reused across files and retry attempts.
+    connector = aiohttp.TCPConnector(
+        limit=max_concurrency, limit_per_host=max_concurrency, keepalive_timeout=75, ttl_dns_cache=300
+    )
+    headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+    # Bound every request so a single stalled call cannot hang the whole run.
+    timeout = aiohttp.ClientTimeout(sock_connect=5, sock_read=read_timeout)
+    async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout) as session:
+        return await asyncio.gather(*[
+            process_combined_text_file(
+                session, sem, limiter, file_path, filename_to_link_mapping, api_url, max_retries, initial_delay, max_output_tokens,
+                prompt_template, response_schema, defined_fields, fields_for_prompt
+            )
+            for file_path in file_paths
+        ])
+
 def main():
     """Main execution function to read config, get user input, and process files."""
-    config = configparser.ConfigParser()
-    config.read('config.ini')
+    config = get_config()
 
     # 1. Load settings from config.ini
     try:
@@ -123,10 +236,17 @@ def main():
         model_name = config.get('Gemini', 'model_name')
         max_retries = config.getint('Gemini', 'max_retries')
         initial_delay = config.getint('Gemini', 'initial_delay')
+        max_concurrency = config.getint('Gemini', 'max_concurrency', fallback=4)
+        max_output_tokens = config.getint('Gemini', 'max_output_tokens', fallback=4096)
+        read_timeout = config.getint('Gemini', 'read_timeout', fallback=60)
+        requests_per_minute = config.getint('Gemini', 'requests_per_minute', fallback=15)
+        tokens_per_minute = config.getint('Gemini', 'tokens_per_minute', fallback=1000000)
 
         # Gemini schema and prompt settings
-        schema_string = config.get('GeminiSchema', 'response_schema')
-        response_schema = json.loads(schema_string) # Parse the JSON string into a dictionary
+        response_schema = get_schema()
+        # Computed once per run and shared by every file's prompt and result processing
+        defined_fields = tuple(response_schema['items']['properties'])
+        fields_for_prompt = ", ".join(defined_fields)
         prompt_template = config.get('Prompts', 'financial_extraction_prompt')
 
     except (configparser.Error, json.JSONDecodeError, KeyError) as e:
@@ -152,22 +272,29 @@ def main():
     filename_to_link_mapping = load_metadata(source_folder)
     print(f"\nLoaded metadata for {len(filename_to_link_mapping)} files.")
     
-    all_processed_data = []
     text_files = [f for f in os.listdir(raw_texts_folder) if f.endswith('.txt')]
+    file_paths = [os.path.join(raw_texts_folder, filename) for filename in text_files]
 
-    for filename in text_files:
-        file_path = os.path.join(raw_texts_folder, filename)
-        print(f"\n--- Processing file: {filename} ---")
-        
-        processed_data = process_combined_text_file(
-            file_path, filename_to_link_mapping, api_url, max_retries, initial_delay, prompt_template, response_schema
-        )
-        all_processed_data.extend(processed_data)
-        time.sleep(1)
+    if max_concurrency <= 0:
+        print("Warning: max_concurrency must be 1 or greater. Defaulting to 1.")
+        max_concurrency = 1
+    if requests_per_minute <= 0 or tokens_per_minute <= 0:
+        print("Error: requests_per_minute and tokens_per_minute in config.ini must be greater than 0.")
+        sys.exit(1)
+
+    results = asyncio.run(run_all(
+        file_paths, filename_to_link_mapping, api_url, max_retries, initial_delay, max_output_tokens,
+        prompt_template, response_schema, defined_fields, fields_for_prompt, max_concurrency, read_timeout,
+        requests_per_minute, tokens_per_minute
+    ))
+    all_processed_data = [transaction for processed_data in results for transaction in processed_data]
 
     # 4. Save results
-    with open(PROCESSED_DATA_OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(all_processed_data, f, indent=4)
+    with open(PROCESSED_DATA_OUTPUT_FILE, 'wb') as f:
+        f.write(orjson.dumps(all_processed_data, option=orjson.OPT_INDENT_2))
+    # Record the columns next to the data so output_to_csv does not need to re-parse config.ini
+    with open(get_headers_sidecar_path(PROCESSED_DATA_OUTPUT_FILE), 'wb') as f:
+        f.write(orjson.dumps({'headers': list(get_headers())}, option=orjson.OPT_INDENT_2))
     print(f"\nExtraction complete. All data saved to: {PROCESSED_DATA_OUTPUT_FILE}")
     print(f"Total transactions extracted: {len(all_processed_data)}")
 
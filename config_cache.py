@@ -0,0 +1,27 @@
+import os
+import json
+import functools
+import configparser
+
+CONFIG_FILE = 'config.ini'
+
+@functools.lru_cache(maxsize=1)
+def get_config():
+    """Reads config.ini once per process and returns the parsed ConfigParser."""
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    return config
+
+@functools.lru_cache(maxsize=1)
+def get_schema():
+    """Parses the Gemini response schema from config.ini once per process."""
+    return json.loads(get_config().get('GeminiSchema', 'response_schema'))
+
+@functools.lru_cache(maxsize=1)
+def get_headers():
+    """Returns the output columns: the schema's item properties plus the script-added 'drive_link'."""
+    return tuple(get_schema()['items']['properties']) + ('drive_link',)
+
+def get_headers_sidecar_path(data_file):
+    """Path of the '<data file>.headers.json' sidecar that records the output columns next to the data."""
+    return os.path.splitext(data_file)[0] + '.headers.json'
@@ -1,16 +1,21 @@
 import os  
-import io
-from collections import Counter
-import json 
+import shutil
+import hashlib
+from collections import Counter, deque
 import sys 
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from google.auth.transport.requests import Request
+import orjson
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
+from requests.adapters import HTTPAdapter
 
 
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
@@ -50,98 +55,224 @@ def authenticate():
             token.write(creds.to_json())
     return creds
 
-def download_folder_recursively(service, folder_id, local_path, files_metadata):
-    
-    if not os.path.exists(local_path):
-        os.makedirs(local_path)
-
-    # --- Define Google Docs MIME types and their export formats ---
-    export_mimetypes = {
-        'application/vnd.google-apps.document': {
-            'mimeType': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'extension': '.docx'
-        },
-        'application/vnd.google-apps.spreadsheet': {
-            'mimeType': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'extension': '.xlsx'
-        },
-        'application/vnd.google-apps.presentation': {
-            'mimeType': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-            'extension': '.pptx'
-        }
+# --- Define Google Docs MIME types and their export formats ---
+EXPORT_MIMETYPES = {
+    'application/vnd.google-apps.document': {
+        'mimeType': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        'extension': '.docx'
+    },
+    'application/vnd.google-apps.spreadsheet': {
+        'mimeType': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'extension': '.xlsx'
+    },
+    'application/vnd.google-apps.presentation': {
+        'mimeType': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+        'extension': '.pptx'
     }
+}
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+DOWNLOAD_WORKERS = 8
+LIST_BATCH_SIZE = 8  # Folder listings sent per batched Drive request
+MAX_LIST_RETRIES = 5
+DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+COPY_BUFFER_SIZE = 1024 * 1024
+
+_thread_local = threading.local()
+
+def get_thread_service(creds):
+    """Drive service objects are not thread-safe, so each download thread builds its own."""
+    if not hasattr(_thread_local, 'service'):
+        _thread_local.service = build('drive', 'v3', credentials=creds)
+    return _thread_local.service
+
+def list_folders_batch(service, folders):
+    """
+    Lists one page of children for every (folder_id, local_path, page_token, attempt) in a single
+    batched HTTP request. Returns a (response, exception) pair per folder, in the same order.
+    """
+    responses = {}
 
-    page_token = None
-    while True:
-        query = f"'{folder_id}' in parents and trashed = false"
-        results = service.files().list(
-            q=query,
+    def on_response(request_id, response, exception):
+        responses[request_id] = (response, exception)
+
+    batch = service.new_batch_http_request(callback=on_response)
+    for index, (folder_id, _, page_token, _) in enumerate(folders):
+        batch.add(service.files().list(
+            q=f"'{folder_id}' in parents and trashed = false",
             pageSize=100,
-            fields="nextPageToken, files(id, name, mimeType, webViewLink)",
+            # A stable order keeps the same item on the plain name when a folder is updated again.
+            orderBy="createdTime",
+            fields="nextPageToken, files(id, name, mimeType, webViewLink, md5Checksum, size, modifiedTime)",
             pageToken=page_token
-        ).execute()
-        
-        items = results.get('files', [])
-
-        for item in items:
-            item_name = item.get('name')
-            item_id = item.get('id')
-            item_mimetype = item.get('mimeType')
-            item_link = item.get('webViewLink')
-
-            if item_mimetype == 'application/vnd.google-apps.folder':
-                subfolder_path = os.path.join(local_path, item_name)
-                print(f"Entering subfolder: {item_name}")
-                download_folder_recursively(service, item_id, subfolder_path, files_metadata)
-            
-            elif item_mimetype in export_mimetypes:
-                export_details = export_mimetypes[item_mimetype]
-                export_mimetype = export_details['mimeType']
-                export_extension = export_details['extension']
-                
-                new_filename = item_name + export_extension
-                current_local_path = os.path.join(local_path, new_filename)
-                
+        ), request_id=str(index))
+    batch.execute()
+    missing = (None, RuntimeError("no response was returned for this folder in the batch"))
+    return [responses.get(str(index), missing) for index in range(len(folders))]
+
+def is_retryable_list_error(error):
+    """Rate limits (429, or 403 rate-limit reasons), server errors and missing batch responses are worth retrying."""
+    if not isinstance(error, HttpError):
+        return True
+    status = error.resp.status
+    if status == 429 or status >= 500:
+        return True
+    return status == 403 and 'ratelimitexceeded' in str(error).lower()
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def is_local_copy_current(item, path):
+    """
+    Checks whether path already holds the current version of the Drive item.
+    Binary files are compared by size and MD5; Google-apps exports have no checksum,
+    so the local file must be at least as recent as the item's modifiedTime.
+    """
+    if not os.path.exists(path):
+        return False
+    if item.get('md5Checksum') and item.get('size') is not None:
+        return os.path.getsize(path) == int(item['size']) and file_md5(path) == item['md5Checksum']
+    if item.get('modifiedTime'):
+        remote_mtime = datetime.fromisoformat(item['modifiedTime'].replace('Z', '+00:00')).timestamp()
+        return os.path.getmtime(path) >= remote_mtime
+    return False
+
+def local_filename(item):
+    """Name the item gets on disk: Google-apps files get the extension of their export format."""
+    if item.get('mimeType') in EXPORT_MIMETYPES:
+        return item.get('name') + EXPORT_MIMETYPES[item.get('mimeType')]['extension']
+    return item.get('name')
+
+def unique_local_name(name, item_id, used_names):
+    """
+    Drive allows several items with the same name in one folder, and a Google Doc 'X' exports to the
+    same name as an uploaded 'X.docx'. Repeated names get the Drive id appended so that concurrent
+    downloads never share a target. Names are compared case-insensitively for macOS/Windows.
+    """
+    if name.lower() in used_names:
+        stem, extension = os.path.splitext(name)
+        name = f"{stem} ({item_id}){extension}"
+    used_names.add(name.lower())
+    return name
+
+def download_file(creds, auth_session, item, local_path, new_filename):
+    """Downloads (or exports) a single Drive file to local_path/new_filename and returns its metadata entry."""
+    item_name = item.get('name')
+    item_id = item.get('id')
+    item_mimetype = item.get('mimeType')
+    current_local_path = os.path.join(local_path, new_filename)
+
+    if is_local_copy_current(item, current_local_path):
+        print(f"  Up to date, skipping: {new_filename}")
+        return {
+            'filename': new_filename,
+            'link': item.get('webViewLink'),
+            'local_path': current_local_path
+        }
+
+    # Download into a temporary file and move it into place only once it is complete, so an
+    # interrupted download never leaves a truncated file that a later run would treat as current.
+    temp_path = current_local_path + '.part'
+    try:
+        with open(temp_path, 'wb') as fh:
+            if item_mimetype in EXPORT_MIMETYPES:
                 print(f"  Exporting: '{item_name}' as '{new_filename}'")
-                request = service.files().export_media(fileId=item_id, mimeType=export_mimetype)
-                fh = io.BytesIO()
+                export_mimetype = EXPORT_MIMETYPES[item_mimetype]['mimeType']
+                request = get_thread_service(creds).files().export_media(fileId=item_id, mimeType=export_mimetype)
+                # Chunks are written straight to disk instead of being buffered in memory first.
                 downloader = MediaIoBaseDownload(fh, request)
                 done = False
                 while not done:
                     status, done = downloader.next_chunk()
-                
-                with open(current_local_path, 'wb') as f:
-                    f.write(fh.getvalue())
-                
-                files_metadata[item_id] = {
-                    'filename': new_filename,
-                    'link': item_link,
-                    'local_path': current_local_path
-                }
-
             else:
-                current_local_path = os.path.join(local_path, item_name)
                 print(f"  Downloading: {item_name}")
-                request = service.files().get_media(fileId=item_id)
-                fh = io.BytesIO()
-                downloader = MediaIoBaseDownload(fh, request)
-                done = False
-                while not done:
-                    status, done = downloader.next_chunk()
-                
-                with open(current_local_path, 'wb') as f:
-                    f.write(fh.getvalue())
-                
-                files_metadata[item_id] = {
-                    'filename': item_name,
-                    'link': item_link,
-                    'local_path': current_local_path
-                }
-        
-        page_token = results.get('nextPageToken', None)
-        if page_token is None:
-            break
+                # Regular files are fetched as one streamed response over the shared keep-alive session
+                # rather than as a series of serial range requests.
+                with auth_session.get(DRIVE_MEDIA_URL.format(file_id=item_id), stream=True) as response:
+                    response.raise_for_status()
+                    response.raw.decode_content = True
+                    shutil.copyfileobj(response.raw, fh, length=COPY_BUFFER_SIZE)
+        os.replace(temp_path, current_local_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return {
+        'filename': new_filename,
+        'link': item.get('webViewLink'),
+        'local_path': current_local_path
+    }
+
+def download_folder(service, creds, folder_id, local_path, files_metadata):
+    """
+    Walks the folder tree breadth-first, listing up to LIST_BATCH_SIZE folders per batched
+    request, and hands each file to the download thread pool as soon as it is listed.
+    Returns a list of descriptions of the folders and files that could not be fetched.
+    """
+    # One pooled session shared by all download threads, sized so every worker can keep a connection open.
+    auth_session = AuthorizedSession(creds)
+    auth_session.mount("https://", HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS))
+
+    pending_downloads = []
+    # Local names already taken in each local folder, so colliding Drive items get distinct targets.
+    used_names = {}
+    failures = []
+    folder_queue = deque([(folder_id, local_path, None, 0)])
+
+    with auth_session, ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        while folder_queue:
+            folders = [folder_queue.popleft() for _ in range(min(LIST_BATCH_SIZE, len(folder_queue)))]
+            for _, folder_path, _, _ in folders:
+                os.makedirs(folder_path, exist_ok=True)
+
+            retry_delay = 0
+            listings = zip(folders, list_folders_batch(service, folders))
+            for (current_folder_id, folder_path, current_page_token, attempt), (results, error) in listings:
+                if error is not None:
+                    if is_retryable_list_error(error) and attempt + 1 < MAX_LIST_RETRIES:
+                        retry_delay = max(retry_delay, 2 ** attempt)
+                        print(f"Error listing folder '{folder_path}', will retry: {error}")
+                        folder_queue.append((current_folder_id, folder_path, current_page_token, attempt + 1))
+                    else:
+                        print(f"Error listing folder '{folder_path}': {error}")
+                        failures.append(f"folder '{folder_path}' (listing failed: {error})")
+                    continue
+
+                folder_used_names = used_names.setdefault(folder_path, set())
+                for item in results.get('files', []):
+                    if item.get('mimeType') == FOLDER_MIMETYPE:
+                        item_name = unique_local_name(item.get('name'), item.get('id'), folder_used_names)
+                        print(f"Entering subfolder: {item_name}")
+                        folder_queue.append((item.get('id'), os.path.join(folder_path, item_name), None, 0))
+                    else:
+                        new_filename = unique_local_name(local_filename(item), item.get('id'), folder_used_names)
+                        future = executor.submit(download_file, creds, auth_session, item, folder_path, new_filename)
+                        pending_downloads.append((item, future))
 
+                # Further pages of a large folder go back on the queue like any other folder.
+                page_token = results.get('nextPageToken')
+                if page_token:
+                    folder_queue.append((current_folder_id, folder_path, page_token, 0))
+
+            # Back off before the next batch when folders were re-queued after rate limits or server errors;
+            # downloads already submitted keep running meanwhile.
+            if retry_delay:
+                time.sleep(retry_delay)
+
+        # Metadata is filled in on this thread, in listing order, so no locking is needed
+        # and files_metadata.json stays in a stable order.
+        for item, future in pending_downloads:
+            try:
+                files_metadata[item.get('id')] = future.result()
+            except Exception as e:
+                print(f"  Error downloading '{item.get('name')}': {e}")
+                failures.append(f"file '{item.get('name')}' (download failed: {e})")
+
+    return failures
 
 def main():
     try:
@@ -167,22 +298,38 @@ def main():
         folder_details = service.files().get(fileId=folder_id, fields='name').execute()
         folder_name = folder_details.get('name', 'Finance')
         
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        root_download_path = f"{timestamp}-{folder_name}"
+        # Reusing a previous download folder only fetches files that changed since then.
+        existing_path = input("Enter an existing download folder to update (leave empty to create a new one): ").strip()
+        if existing_path:
+            if not os.path.isdir(existing_path):
+                print(f"Error: The provided path '{existing_path}' is not a valid directory.")
+                return
+            root_download_path = existing_path
+        else:
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            root_download_path = f"{timestamp}-{folder_name}"
         
         print(f"Starting download process. Files will be saved in: '{root_download_path}'")
         
         files_metadata = {}
-        download_folder_recursively(service, folder_id, root_download_path, files_metadata)
+        failures = download_folder(service, creds, folder_id, root_download_path, files_metadata)
 
         if files_metadata:
             metadata_filepath = os.path.join(root_download_path, 'files_metadata.json')
-            with open(metadata_filepath, 'w') as f:
-                json.dump(files_metadata, f, indent=4)
-            print(f"\nDownload complete. All metadata saved to {metadata_filepath}")
-        else:
+            with open(metadata_filepath, 'wb') as f:
+                f.write(orjson.dumps(files_metadata, option=orjson.OPT_INDENT_2))
+            if failures:
+                print(f"\nDownload incomplete. Metadata for the downloaded files saved to {metadata_filepath}")
+            else:
+                print(f"\nDownload complete. All metadata saved to {metadata_filepath}")
+        elif not failures:
             print("\nNo files were found to download.")
 
+        if failures:
+            print(f"\nWarning: {len(failures)} item(s) could not be fetched and are missing from this download:")
+            for failure in failures:
+                print(f"  - {failure}")
+
     except HttpError as error:
         print(f"An HTTP error occurred: {error}")
         if "invalid" in str(error).lower():
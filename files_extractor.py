@@ -1,11 +1,14 @@
 import os
-import json
 from datetime import datetime
 import shutil
 import sys
-import configparser
+import itertools
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-import PyPDF2
+import pypdfium2 as pdfium
+import orjson
 from docx import Document
 from docx.shared import Inches
 import pytesseract
@@ -13,25 +16,62 @@ from PIL import Image
 import pypandoc
 from pdf2image import convert_from_path
 
+from config_cache import get_config
+
 OUTPUT_SNAPSHOTS_DOCX_TEMPLATE = "Extracted Texts with Snapshots_{}.docx"
 OUTPUT_COMBINED_TEXT_DOCX_TEMPLATE = "Extracted Texts_{}.docx"
 OUTPUT_TEXT_FOLDER_TEMPLATE = "Extracted Texts for Iteration_{}"
+TESSERACT_CONFIG = '--oem 1 --psm 6'  # LSTM engine only, single uniform block of text
+# Files are already extracted one process per CPU, so each image only gets a small page pool
+# and every tesseract process is kept to a single OpenMP thread.
+OCR_PAGE_WORKERS = 2
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+SNAPSHOT_DPI = 100  # Snapshots are embedded 6 inches wide, so higher resolutions are wasted
+
+# PDFium marks a hyphenated line break with U+FFFE (sometimes \x02) in place of the hyphen and newline.
+# Neither character is valid in XML, so python-docx would reject the text when building the reports.
+PDFIUM_HYPHEN_MARKERS = ('\ufffe', '\x02')
+
+def clean_pdfium_text(text):
+    text = text.replace("\r\n", "\n")
+    for marker in PDFIUM_HYPHEN_MARKERS:
+        text = text.replace(marker, "-\n")
+    return text
 
 def extract_text_from_pdf(pdf_path):
-    text = ""
+    parts = []
     try:
-        with open(pdf_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            for page in reader.pages:
-                text += page.extract_text() or ""
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                parts.append(clean_pdfium_text(textpage.get_text_range()))
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
     except Exception as e:
         print(f"Error extracting text from PDF {pdf_path}: {e}")
-    return text
+    return "".join(parts)
+
+def ocr_image(image):
+    return pytesseract.image_to_string(image, config=TESSERACT_CONFIG)
 
 def extract_text_from_image(image_path):
     text = ""
     try:
-        text = pytesseract.image_to_string(Image.open(image_path))
+        with Image.open(image_path) as image:
+            frame_count = getattr(image, 'n_frames', 1)
+            if frame_count <= 1:
+                text = ocr_image(image)
+            else:
+                # Multi-page TIFFs: OCR every page in parallel (tesseract runs out of process).
+                frames = []
+                for index in range(frame_count):
+                    image.seek(index)
+                    frames.append(image.copy())
+                with ThreadPoolExecutor(max_workers=min(frame_count, OCR_PAGE_WORKERS)) as executor:
+                    text = "\n".join(executor.map(ocr_image, frames))
     except pytesseract.TesseractNotFoundError:
         print("Error: Tesseract not found. Please install it and add to PATH to process images.")
     except Exception as e:
@@ -42,13 +82,14 @@ def extract_text_from_docx(docx_path):
     text = ""
     try:
         doc = Document(docx_path)
-        for para in doc.paragraphs:
-            text += para.text + "\n"
+        text = "".join(para.text + "\n" for para in doc.paragraphs)
     except Exception as e:
         print(f"Error extracting text from DOCX {docx_path}: {e}")
     return text
 
 def extract_text_from_doc(doc_path):
+    # Note: pandoc has no reader for legacy binary .doc files, so this conversion fails
+    # and the file contributes no text until it is saved as .docx.
     try:
         return pypandoc.convert_file(doc_path, 'plain')
     except Exception as e:
@@ -69,17 +110,27 @@ def get_file_text(file_path):
         print(f"Skipping unsupported file type for text extraction: {os.path.basename(file_path)}")
         return ""
 
-def create_pdf_snapshot(pdf_path, output_dir):
+def create_pdf_snapshot(pdf_path, output_dir, image_name=None):
     try:
-        images = convert_from_path(pdf_path, first_page=1, last_page=1, dpi=150)
+        images = convert_from_path(pdf_path, first_page=1, last_page=1, dpi=SNAPSHOT_DPI, use_pdftocairo=True)
         if images:
-            image_path = os.path.join(output_dir, f"{os.path.basename(pdf_path)}.png")
+            image_path = os.path.join(output_dir, image_name or f"{os.path.basename(pdf_path)}.png")
             images[0].save(image_path, 'PNG')
             return image_path
     except Exception as e:
         print(f"Error generating PDF snapshot for {os.path.basename(pdf_path)}: {e}. (Is Poppler installed?)")
     return None
 
+def create_pdf_snapshots_batch(pdf_paths, output_dir):
+    """Renders the first page of every PDF concurrently and returns a {pdf_path: snapshot_path} mapping."""
+    if not pdf_paths:
+        return {}
+    # Prefix with the position so PDFs sharing a name in different subfolders do not overwrite each other.
+    image_names = [f"{index}_{os.path.basename(pdf_path)}.png" for index, pdf_path in enumerate(pdf_paths)]
+    with ThreadPoolExecutor(max_workers=min(len(pdf_paths), os.cpu_count() or 1)) as executor:
+        snapshot_paths = executor.map(create_pdf_snapshot, pdf_paths, [output_dir] * len(pdf_paths), image_names)
+        return dict(zip(pdf_paths, snapshot_paths))
+
 def create_word_snapshot(word_path, output_dir):
     temp_pdf_path = os.path.join(output_dir, f"{os.path.basename(word_path)}.pdf")
     snapshot_path = None
@@ -110,79 +161,124 @@ def get_file_snapshot(file_path, temp_dir):
     else:
         return None
 
-def create_snapshots_docx(extracted_data, output_path, root_folder):
-    document = Document()
-    document.add_heading('Raw Text Extraction with Visual Snapshots', level=1)
-    document.add_paragraph(f"Report generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+class SnapshotsDocxWriter:
+    """Builds the text + snapshot report one entry at a time; close() saves it."""
+    def __init__(self, output_path, root_folder, pdf_paths):
+        self.output_path = output_path
+        self.document = Document()
+        self.document.add_heading('Raw Text Extraction with Visual Snapshots', level=1)
+        self.document.add_paragraph(f"Report generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+        self.temp_dir = os.path.join(root_folder, 'temp_snapshots_deleteme')
+        os.makedirs(self.temp_dir, exist_ok=True)
 
-    temp_dir = os.path.join(root_folder, 'temp_snapshots_deleteme')
-    os.makedirs(temp_dir, exist_ok=True)
+        # Render all PDF snapshots up front in one batch instead of one blocking call per entry.
+        self.pdf_snapshots = create_pdf_snapshots_batch(list(dict.fromkeys(pdf_paths)), self.temp_dir)
 
-    for entry in extracted_data:
+    def add(self, entry):
         filename = entry.get('filename', 'N/A')
         text_content = entry.get('text', 'No text could be extracted.')
         file_path = entry.get('file_path', '')
 
-        document.add_heading(f"File: {filename}", level=2)
-        document.add_paragraph("--- Extracted Text ---").add_run().bold = True
-        document.add_paragraph(text_content or "[No text extracted]")
+        self.document.add_heading(f"File: {filename}", level=2)
+        self.document.add_paragraph("--- Extracted Text ---").add_run().bold = True
+        self.document.add_paragraph(text_content or "[No text extracted]")
         
-        document.add_paragraph("\n--- Snapshot ---").add_run().bold = True
-        snapshot_path = get_file_snapshot(file_path, temp_dir)
+        self.document.add_paragraph("\n--- Snapshot ---").add_run().bold = True
+        if file_path in self.pdf_snapshots:
+            snapshot_path = self.pdf_snapshots[file_path]
+        else:
+            snapshot_path = get_file_snapshot(file_path, self.temp_dir)
         if snapshot_path and os.path.exists(snapshot_path):
             try:
-                document.add_picture(snapshot_path, width=Inches(6.0))
+                self.document.add_picture(snapshot_path, width=Inches(6.0))
             except Exception as e:
-                document.add_paragraph(f"[Error embedding snapshot: {e}]")
+                self.document.add_paragraph(f"[Error embedding snapshot: {e}]")
         else:
-            document.add_paragraph("[Snapshot not available or could not be generated.]")
-        document.add_page_break()
+            self.document.add_paragraph("[Snapshot not available or could not be generated.]")
+        self.document.add_page_break()
 
-    try:
-        document.save(output_path)
-        print(f"\nSuccessfully saved snapshot report to: {output_path}")
-    except Exception as e:
-        print(f"\nError saving snapshot DOCX report: {e}")
-    finally:
-        shutil.rmtree(temp_dir) # Clean up temp snapshot folder
-
-def create_combined_text_docx(extracted_data, output_path):
-    document = Document()
-    document.add_heading('Combined Raw Text Extraction', level=1)
-    document.add_paragraph(f"Report generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-
-    for entry in extracted_data:
+    def close(self):
+        try:
+            self.document.save(self.output_path)
+            print(f"\nSuccessfully saved snapshot report to: {self.output_path}")
+        except Exception as e:
+            print(f"\nError saving snapshot DOCX report: {e}")
+        finally:
+            shutil.rmtree(self.temp_dir) # Clean up temp snapshot folder
+
+    def discard(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+class CombinedTextDocxWriter:
+    """Builds the combined text report one entry at a time; close() saves it."""
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.document = Document()
+        self.document.add_heading('Combined Raw Text Extraction', level=1)
+        self.document.add_paragraph(f"Report generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    def add(self, entry):
         filename = entry.get('filename', 'N/A')
         text_content = entry.get('text', 'No text could be extracted.')
-        document.add_heading(f"--- File: {filename} ---", level=2)
-        document.add_paragraph(text_content or "[No text extracted]")
-        document.add_paragraph("\n" + "="*80 + "\n")
+        self.document.add_heading(f"--- File: {filename} ---", level=2)
+        self.document.add_paragraph(text_content or "[No text extracted]")
+        self.document.add_paragraph("\n" + "="*80 + "\n")
 
-    try:
-        document.save(output_path)
-        print(f"Successfully saved combined text report to: {output_path}")
-    except Exception as e:
-        print(f"Error saving combined text DOCX report: {e}")
+    def close(self):
+        try:
+            self.document.save(self.output_path)
+            print(f"Successfully saved combined text report to: {self.output_path}")
+        except Exception as e:
+            print(f"Error saving combined text DOCX report: {e}")
+
+    def discard(self):
+        pass
+
+class IndividualTextFilesWriter:
+    """
+    Writes text files of combine_count entries each, keeping only the current chunk in memory.
+    Files go to an '(incomplete)' folder that replaces output_dir only in close(), so a failed
+    run never leaves a partial folder where ai_processor.py expects a finished one.
+    """
+    def __init__(self, output_dir, combine_count):
+        self.work_dir = output_dir + " (incomplete)"
+        if os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+        os.makedirs(self.work_dir, exist_ok=True)
+        
+        print(f"Creating individual/combined text files in: {output_dir}")
 
-def create_individual_text_files(extracted_data, output_dir, combine_count):
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    os.makedirs(output_dir, exist_ok=True)
-    
-    print(f"Creating individual/combined text files in: {output_dir}")
+        if combine_count <= 0:
+            print("Warning: TEXT_FILE_COMBINATION_COUNT must be 1 or greater. Defaulting to 1.")
+            combine_count = 1
 
-    if combine_count <= 0:
-        print("Warning: TEXT_FILE_COMBINATION_COUNT must be 1 or greater. Defaulting to 1.")
-        combine_count = 1
+        self.output_dir = output_dir
+        self.combine_count = combine_count
+        self.chunk = []
+
+    def add(self, entry):
+        self.chunk.append(entry)
+        if len(self.chunk) >= self.combine_count:
+            self._write_chunk()
+
+    def close(self):
+        if self.chunk:
+            self._write_chunk()
+        if os.path.exists(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.rename(self.work_dir, self.output_dir)
+
+    def discard(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _write_chunk(self):
+        chunk, self.chunk = self.chunk, []
 
-    num_entries = len(extracted_data)
-    for i in range(0, num_entries, combine_count):
-        chunk = extracted_data[i:i + combine_count]
-        
         # Create a filename for the combined text file.
         base_filenames = [os.path.splitext(entry['filename'])[0] for entry in chunk]
         out_filename = "_and_".join(base_filenames) + ".txt"
-        out_filepath = os.path.join(output_dir, out_filename)
+        out_filepath = os.path.join(self.work_dir, out_filename)
 
         try:
             with open(out_filepath, 'w', encoding='utf-8') as f:
@@ -195,9 +291,74 @@ def create_individual_text_files(extracted_data, output_dir, combine_count):
         except Exception as e:
             print(f"Error saving text file '{out_filename}': {e}")
 
+def extract_in_isolation(file_path):
+    """Extracts one file in its own single-worker pool, so a worker crash can only come from this file."""
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(get_file_text, file_path).result()
+        except BrokenProcessPool as e:
+            print(f"Error extracting text from {file_path}: worker process crashed ({e})")
+        except Exception as e:
+            print(f"Error extracting text from {file_path}: {e}")
+    return ""
+
+def extract_entries(valid_entries):
+    """
+    Yields one extracted entry per (filename, file_path) as soon as it is ready.
+    PDF parsing, OCR and pandoc conversions are CPU-bound, so each file is extracted in its own process.
+    Results are yielded in metadata order to keep the generated reports deterministic.
+    At most two files per worker are in flight, and each result is released once yielded,
+    so only a window of extracted texts is held in memory at any time.
+    """
+    max_workers = os.cpu_count() or 1
+    pending_entries = iter(valid_entries)
+    in_flight = deque()
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    try:
+        for filename, file_path in itertools.islice(pending_entries, 2 * max_workers):
+            in_flight.append((filename, file_path, executor.submit(get_file_text, file_path)))
+
+        while in_flight:
+            filename, file_path, future = in_flight.popleft()
+            try:
+                document_text = future.result()
+            except BrokenProcessPool:
+                # Once any worker dies, every unfinished future fails, so the crash cannot be pinned
+                # on this entry. Re-run each affected file on its own; only a file that crashes a
+                # fresh pool by itself is skipped. Queued files that already finished keep their text.
+                executor.shutdown(wait=False)
+                document_text = extract_in_isolation(file_path)
+                recovered = deque()
+                for queued_name, queued_path, queued_future in in_flight:
+                    if not (queued_future.done() and queued_future.exception() is None):
+                        queued_future = Future()
+                        queued_future.set_result(extract_in_isolation(queued_path))
+                    recovered.append((queued_name, queued_path, queued_future))
+                in_flight = recovered
+                executor = ProcessPoolExecutor(max_workers=max_workers)
+            except Exception as e:
+                print(f"Error extracting text from {file_path}: {e}")
+                document_text = ""
+            del future
+
+            next_entry = next(pending_entries, None)
+            if next_entry is not None:
+                next_name, next_path = next_entry
+                in_flight.append((next_name, next_path, executor.submit(get_file_text, next_path)))
+
+            print(f"  - Processed: {filename}")
+
+            yield {
+                "filename": filename,
+                "text": document_text,
+                "file_path": file_path,
+            }
+    finally:
+        executor.shutdown()
+
 def main():
-    config = configparser.ConfigParser()
-    config.read('config.ini')
+    config = get_config()
     text_file_combination_count = config.getint('Settings', 'combination_count', fallback=1)
 
     target_folder_path = input("Please enter the path to the folder to process: ").strip()
@@ -214,12 +375,12 @@ def main():
         print(f"Error: 'files_metadata.json' not found in '{target_folder_path}'.")
         sys.exit(1)
 
-    with open(metadata_path, 'r', encoding='utf-8') as f:
-        metadata = json.load(f)
+    with open(metadata_path, 'rb') as f:
+        metadata = orjson.loads(f.read())
 
-    all_extracted_data = []
     print(f"\nProcessing files from: {target_folder_path}")
 
+    valid_entries = []
     for file_id, file_info in metadata.items():
         filename = file_info.get('filename')
         file_path = file_info.get('local_path')
@@ -227,33 +388,48 @@ def main():
         if not (filename and file_path and os.path.isfile(file_path)):
             print(f"Warning: Skipping invalid entry (ID: {file_id}). File may be missing.")
             continue
+        valid_entries.append((filename, file_path))
 
-        print(f"  - Processing: {filename}")
-        document_text = get_file_text(file_path)
-        
-        all_extracted_data.append({
-            "filename": filename,
-            "text": document_text,
-            "file_path": file_path,
-        })
-
-    print("\n--- All Files Processed ---")
-
-    if not all_extracted_data:
+    if not valid_entries:
         print("No text was extracted from any files. No output files will be generated.")
         return
 
     snapshot_report_name = OUTPUT_SNAPSHOTS_DOCX_TEMPLATE.format(target_folder_name)
     snapshot_report_path = os.path.join(output_directory, snapshot_report_name)
-    create_snapshots_docx(all_extracted_data, snapshot_report_path, output_directory)
+    pdf_paths = [file_path for _, file_path in valid_entries if os.path.splitext(file_path)[1].lower() == '.pdf']
 
     combined_text_name = OUTPUT_COMBINED_TEXT_DOCX_TEMPLATE.format(target_folder_name)
     combined_text_path = os.path.join(output_directory, combined_text_name)
-    create_combined_text_docx(all_extracted_data, combined_text_path)
 
     text_folder_name = OUTPUT_TEXT_FOLDER_TEMPLATE.format(target_folder_name)
     text_folder_path = os.path.join(output_directory, text_folder_name)
-    create_individual_text_files(all_extracted_data, text_folder_path, text_file_combination_count)
+
+    # Every extracted entry goes to all three outputs as soon as it is ready; only the
+    # extraction window and the writers' own state (the DOCX trees, the current text chunk) stay in memory.
+    writers = []
+    entries = extract_entries(valid_entries)
+    try:
+        writers.append(SnapshotsDocxWriter(snapshot_report_path, output_directory, pdf_paths))
+        writers.append(CombinedTextDocxWriter(combined_text_path))
+        writers.append(IndividualTextFilesWriter(text_folder_path, text_file_combination_count))
+
+        for entry in entries:
+            for writer in writers:
+                writer.add(entry)
+
+    except BaseException:
+        # A partial run must not look like a finished one: stop the worker pool, drop the
+        # temporary files and save nothing, leaving any previous outputs untouched.
+        entries.close()
+        for writer in writers:
+            writer.discard()
+        print("\nExtraction did not finish. No reports were written.")
+        raise
+
+    print("\n--- All Files Processed ---")
+
+    for writer in writers:
+        writer.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -4,10 +4,15 @@ import csv
 import sys
 import configparser
 
+import orjson
+
+from config_cache import get_headers, get_headers_sidecar_path
+
 def transform_data_to_csv(input_json_file, output_csv_file):
     """
     Reads structured data from the input JSON file and writes it to a CSV file,
-    with columns generated dynamically from the config.ini schema.
+    with columns taken from the headers sidecar written by ai_processor.py,
+    or generated dynamically from the config.ini schema if it is missing.
     """
     # --- Step 1: Check for the input JSON file ---
     if not os.path.exists(input_json_file):
@@ -17,43 +22,44 @@ def transform_data_to_csv(input_json_file, output_csv_file):
 
     # --- Step 2: Load the AI's extracted data ---
     try:
-        with open(input_json_file, 'r', encoding='utf-8') as f:
-            extracted_data = json.load(f)
+        with open(input_json_file, 'rb') as f:
+            extracted_data = orjson.loads(f.read())
     except (json.JSONDecodeError, Exception) as e:
         print(f"Error reading '{input_json_file}': {e}")
         return False
 
-    # --- Step 3: Dynamically generate headers from config.ini ---
-    try:
-        config = configparser.ConfigParser()
-        config.read('config.ini')
-        schema_string = config.get('GeminiSchema', 'response_schema')
-        response_schema = json.loads(schema_string)
-        
-        # Get headers directly from the keys in the schema's "properties"
-        headers = list(response_schema['items']['properties'].keys())
-        
-        # The 'drive_link' is added by the script, not the AI, so we add it manually.
-        headers.append('drive_link')
+    # --- Step 3: Load headers from the sidecar, falling back to config.ini ---
+    headers = None
+    headers_file = get_headers_sidecar_path(input_json_file)
+    if os.path.exists(headers_file):
+        try:
+            with open(headers_file, 'rb') as f:
+                headers = orjson.loads(f.read())['headers']
+            if not isinstance(headers, list) or not all(isinstance(header, str) for header in headers):
+                raise TypeError("'headers' must be a list of column names")
+        except (json.JSONDecodeError, KeyError, TypeError, OSError) as e:
+            headers = None
+            print(f"Warning: Could not read '{headers_file}', using config.ini instead. Details: {e}")
 
-    except (configparser.Error, json.JSONDecodeError, KeyError) as e:
-        print(f"Error reading schema from config.ini to generate headers. Details: {e}")
-        return False
+    if headers is None:
+        try:
+            # Headers are the keys in the schema's "properties" plus the script-added 'drive_link'
+            headers = list(get_headers())
+
+        except (configparser.Error, json.JSONDecodeError, KeyError) as e:
+            print(f"Error reading schema from config.ini to generate headers. Details: {e}")
+            return False
 
     # --- Step 4: Write the data to the CSV file ---
     try:
         with open(output_csv_file, 'w', newline='', encoding='utf-8') as outfile:
-            csv_writer = csv.writer(outfile)
+            # DictWriter maps each transaction to the correct column by key;
+            # missing fields become "N/A" and keys outside the headers are ignored.
+            csv_writer = csv.DictWriter(outfile, fieldnames=headers, restval="N/A", extrasaction='ignore')
 
             # Write the dynamically generated header row
-            csv_writer.writerow(headers)
-
-            # Loop through each transaction and write the data
-            for item in extracted_data:
-                # Create the row dynamically using the headers list
-                # This ensures the data maps to the correct column automatically
-                row = [item.get(header, "N/A") for header in headers]
-                csv_writer.writerow(row)
+            csv_writer.writeheader()
+            csv_writer.writerows(extracted_data)
 
         print(f"\nSuccessfully transformed data and created CSV file: {output_csv_file}")
         print(f"Columns were generated automatically: {', '.join(headers)}")
@@ -71,7 +77,7 @@ def main():
 
     if transform_data_to_csv(PROCESSED_DATA_INPUT_FILE, OUTPUT_CSV_FILE):
         print("\n" + "="*80)
-        print("CSV File Generated. Columns were created automatically based on your config.ini.")
+        print("CSV File Generated. Columns were taken from the headers file saved with the data, or from config.ini if it was missing.")
         print("="*80)
     else:
         print("\nData transformation failed. Please check the errors listed above.")